@@ -1,58 +1,79 @@
 # import libraries
 import argparse # for parsing command line arguments
 import collections # for OrderedDict (few more container types than the base lib)
-import configparser # for parsing configuration files (git uses a configuration file that is basically Microsoft's .ini format)
 from datetime import datetime # for datetime objects
-import grp, pwd # for group and user information (to display nicely)
-from fnmatch  import fnmatch # for globbing (to support .gitignore)
+try:
+    import grp, pwd # for group and user information (to display nicely)
+except ImportError:
+    grp = pwd = None # not available on Windows: we show numeric IDs instead
+from fnmatch  import translate # for globbing (to support .gitignore), as regular expressions
+import functools # for caching (lru_cache)
 import hashlib # for hashing (git uses SHA-1 function quite extensively)
-from math import ceil # for rounding up
+import mmap # for mapping object files in memory instead of reading them
 import os # for filesystem operations
 import re # for regular expressions
+from stat import S_ISDIR, S_ISREG # for checking what kind of file a stat result is
+import struct # for decoding binary records (the index)
 import sys # for system operations
-import zlib # for compression (git uses zlib to compress objects)
+import threading # for thread identifiers (to name temporary files)
+import time # for the current time (to spot files modified too recently to cache their hash)
+try:
+    from zlib_ng import zlib_ng as zlib # faster drop-in zlib (pip install zlib-ng), SIMD checksums and matching
+except ImportError:
+    import zlib # for compression (git uses zlib to compress objects)
+
+# subcommands
+# Building an argparse parser isn't cheap, and we have one per command,
+# while a given run only ever needs one of them.  So the add_parser /
+# add_argument / set_defaults calls below are only recorded, and
+# main replays those of the command being run (or all of them, to
+# print the help or an error listing every command).
+class LazyParser(object):
+    """The add_argument and set_defaults calls of a subcommand, to build its parser later."""
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs # the arguments to add_parser
+        self.calls = list()
+
+    def add_argument(self, *args, **kwargs):
+        self.calls.append(("add_argument", args, kwargs))
+
+    def set_defaults(self, **kwargs):
+        self.calls.append(("set_defaults", (), kwargs))
+
+class LazySubparsers(object):
+    """Records subcommands, and builds their parsers on demand."""
+    def __init__(self):
+        self.commands = dict() # name -> LazyParser, in the order they are defined
+
+    def add_parser(self, name, **kwargs):
+        self.commands[name] = LazyParser(**kwargs)
+        return self.commands[name]
+
+    def build(self, argv):
+        """Return an argparse parser for argv."""
+        argparser = argparse.ArgumentParser(description='The clueless code collector')
+        # need to handle subcommands (init, add, etc.)
+        # dest='command' argument that the name of the chosen subparser will be returned as a string in a variable called command
+        subparsers = argparser.add_subparsers(title='Commands', dest='command')
+        subparsers.required = True
+
+        if argv and argv[0] in self.commands:
+            names = [ argv[0] ]
+        else:
+            names = self.commands.keys()
+        for name in names:
+            cmd = self.commands[name]
+            argsp = subparsers.add_parser(name, **cmd.kwargs)
+            for method, args, kwargs in cmd.calls:
+                getattr(argsp, method)(*args, **kwargs)
+        return argparser
 
 # add arguments
-argparser = argparse.ArgumentParser(description='The clueless code collector')
-# need to handle subcommands (init, add, etc.)
-argsubparsers = argparser.add_subparsers(title='Commands', dest='command')
-argsubparsers.required = True
+argsubparsers = LazySubparsers()
 
-# dest='command' argument that the name of the chosen subparser will be returned as a string in a variable called command
 def main(argv=sys.argv[1:]):
-    args = argparser.parse_args(argv)
-    if args.command == "add":
-        cmd_add(args)
-    elif args.command == "cat-file":
-        cmd_cat_file(args)
-    elif args.command == "check-ignore":
-        cmd_check_ignore(args)
-    elif args.command == "checkout":
-        cmd_checkout(args)
-    elif args.command == "commit":
-        cmd_commit(args)
-    elif args.command == "hash-object":
-        cmd_hash_object(args)
-    elif args.command == "init":
-        cmd_init(args)
-    elif args.command == "log":
-        cmd_log(args)
-    elif args.command == "ls-files":
-        cmd_ls_files(args)
-    elif args.command == "ls-tree":
-        cmd_ls_tree(args)
-    elif args.command == "rev-parse":
-        cmd_rev_parse(args)
-    elif args.command == "rm":
-        cmd_rm(args)
-    elif args.command == "show-ref":
-        cmd_show_ref(args)
-    elif args.command == "status":
-        cmd_status(args)
-    elif args.command == "tag":
-        cmd_tag(args)
-    else:
-        print("Bad command.")
+    args = argsubparsers.build(argv).parse_args(argv)
+    args.func(args) # each subparser sets func to its cmd_* function, see set_defaults below
 
 # git repository
 class GitRepository:
@@ -60,34 +81,107 @@ class GitRepository:
 
     worktree = None # the working directory
     gitdir = None # the git directory
-    conf = None # the configuration
+    objects_dir = None # the object store (.git/objects), used on every object access
+    force = False # whether checks are disabled
+    dir_cache = None # directories known to exist, see repo_dir
 
     def __init__(self, path, force=False): # constructor takes an optional force argument which disables all checks
         self.worktree = path # the working directory
         self.gitdir = os.path.join(path, '.git') # the git directory
+        self.objects_dir = os.path.join(self.gitdir, 'objects') # the object store
+        self.force = force
+        self.dir_cache = set()
 
         if not (force or os.path.isdir(self.gitdir)):
             raise Exception(f'Not a git repository {path}') # if the git directory does not exist, raise an exception
-        
-        # read the configuration file in .git/config
-        self.conf = configparser.ConfigParser() # create a configuration parser object
+
+        if not (force or os.path.isfile(repo_path(self, 'config'))):
+            raise Exception('Configuration file missing') # if the configuration file does not exist, raise an exception
+
+    # the configuration (.git/config) is only parsed the first time it's needed:
+    # object reads never look at it, so they don't pay for it.  The
+    # repositoryformatversion check happens here too, on that first access.
+    @functools.cached_property
+    def conf(self):
+        conf = GitConfig() # start from an empty configuration
         cf = repo_file(self, 'config') # get the configuration file
 
         if cf and os.path.exists(cf):
-            self.conf.read([cf]) # read the configuration file
-        elif not force:
-            raise Exception('Configuration file missing') # if the configuration file does not exist, raise an exception
-        
+            conf = repo_config_read(cf) # read the configuration file (or reuse the last parse)
+
         # check the version of the configuration file
-        if not force:
-            vers = int(self.conf.get('core', 'repositoryformatversion')) # get the version of the configuration file
+        if not self.force:
+            vers = int(conf.get('core', 'repositoryformatversion')) # get the version of the configuration file
             if vers != 0:
                 raise Exception(f'Unsupported repositoryformatversion {vers}') # if the version is not 0, raise an exception
 
+        return conf
+
+    # (device, inode) of the object store.  With gitdir, it's what the
+    # object cache is keyed on: a repository deleted and created again at
+    # the same path must not get the old one's objects.
+    @functools.cached_property
+    def objects_id(self):
+        st = os.stat(self.objects_dir)
+        return (st.st_dev, st.st_ino)
+
 ############################################################################################
 #------------------------------------ REPOSITORY FUNCTIONS --------------------------------#
 ############################################################################################
 
+# .git/config reader
+# configparser does a lot of work we don't need (interpolation, defaults,
+# ordered bookkeeping) for a file that usually holds a single [core]
+# section.  Two regular expressions are enough to read it.
+class GitConfig(object):
+    """The sections and keys of a .git/config file."""
+    section_re = re.compile(r'^[ \t]*\[([^\]]+)\][ \t]*$', re.M) # [section]
+    kv_re = re.compile(r'^[ \t]*([A-Za-z0-9_-]+)[ \t]*=[ \t]*(.*?)[ \t]*$', re.M) # key = value
+
+    sections = None
+
+    def __init__(self, text=""):
+        self.sections = dict()
+
+        # Each section runs from its header to the next one (or the end of the file)
+        headers = list(self.section_re.finditer(text))
+        for i, header in enumerate(headers):
+            end = headers[i+1].start() if i+1 < len(headers) else len(text)
+            section = self.sections.setdefault(header.group(1).strip(), dict())
+            for kv in self.kv_re.finditer(text, header.end(), end):
+                section[kv.group(1).lower()] = kv.group(2) # keys are case-insensitive, like in git
+
+    def get(self, section, key, fallback=KeyError):
+        if section not in self.sections or key.lower() not in self.sections[section]:
+            if fallback is not KeyError: # any value, None included, can be a fallback
+                return fallback
+            raise Exception(f'Missing configuration value {section}.{key}')
+        return self.sections[section][key.lower()]
+
+# parsed configuration files, keyed by path: {path: (mtime_ns, GitConfig)}
+config_cache = dict()
+
+def repo_config_read(path):
+    """Parse the configuration file at path, reusing the previous parse if the file hasn't changed since."""
+    mtime = os.stat(path).st_mtime_ns # the modification time tells us if the cached parse is still valid
+    cached = config_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, 'r') as f: # read the configuration file
+        conf = GitConfig(f.read())
+    config_cache[path] = (mtime, conf)
+    return conf
+
+def file_stamp(path):
+    """What we compare to tell if the file at path changed since we last
+    parsed it: (mtime_ns, size, inode), or None if there is no such file."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
 def repo_path(repo, *path):
     """Compute path under repo's gitdir."""
     return os.path.join(repo.gitdir, *path) # join the path with the git directory
@@ -97,16 +191,37 @@ def repo_file(repo, *path, mkdir=False):
     if repo_dir(repo, *path[:-1], mkdir=mkdir):
         return repo_path(repo, *path) # return the path
 
+def object_path(repo, sha, mkdir=False):
+    """Path of loose object sha.  This is what repo_file(repo, "objects", sha[0:2], sha[2:])
+    computes, without the generic joins and checks: it's called for every object."""
+    if mkdir:
+        os.makedirs(f'{repo.objects_dir}/{sha[0:2]}', exist_ok=True)
+    return f'{repo.objects_dir}/{sha[0:2]}/{sha[2:]}'
+
 def repo_dir(repo, *path, mkdir=False):
     """Same as repo_path, but mkdir *path if absent if mkdir is True."""
     path = repo_path(repo, *path) # get the path
-    if os.path.exists(path): # if the path exists
-        if os.path.isdir(path): # if the path is a directory
-            return path # return the path
-        else:
-            raise Exception(f'Not a directory {path}') # otherwise, raise an exception
+
+    # A single stat tells us both whether the path exists and whether it's
+    # a directory, and directories found are remembered: the same few
+    # (refs, refs/heads, ...) are asked about again and again.  Missing
+    # ones aren't: they can be created behind our back (object_path
+    # creates objects/XX with os.makedirs, for one).
+    if path in repo.dir_cache:
+        return path
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        pass
+    else:
+        if not S_ISDIR(st.st_mode):
+            raise Exception(f'Not a directory {path}') # if the path is not a directory, raise an exception
+        repo.dir_cache.add(path)
+        return path # return the path
+
     if mkdir: # if the path does not exist and mkdir is True
         os.makedirs(path) # make the directory
+        repo.dir_cache.add(path)
         return path # return the path
     else:
         return None # otherwise, return None
@@ -114,6 +229,10 @@ def repo_dir(repo, *path, mkdir=False):
 def repo_create(path):
     """Create a new repository at path."""
     repo = GitRepository(path, True) # create a new repository
+    repo_find_cache.clear() # directories under path may have been cached as not being in a repository
+    # a repository may have been there before: forget its objects
+    object_cache_clear()
+    objects_dir_close(repo.gitdir)
     # make sure the directory exists
     # first we make sure the path either doesn't exist or is an empty directory
     if os.path.exists(repo.worktree):
@@ -138,20 +257,17 @@ def repo_create(path):
         f.write("ref: refs/heads/master\n") # write to the HEAD file
 
     with open(repo_file(repo, "config"), "w") as f: # open the config file
-        config = repo_default_config() # get the default configuration
-        config.write(f) # write the default configuration to the config file
+        f.write(repo_default_config()) # write the default configuration to the config file
 
     return repo
 
 def repo_default_config(): # create a default configuration
-    ret = configparser.ConfigParser() # create a configuration parser object
-
-    ret.add_section("core") # add a core section
-    ret.set("core", "repositoryformatversion", "0") # set the repository format version
-    ret.set("core", "filemode", "false") # set the file mode
-    ret.set("core", "bare", "false") # set the bare flag
-
-    return ret
+    # the text of .git/config, as configparser used to write it
+    return ("[core]\n"
+            "repositoryformatversion = 0\n" # the repository format version
+            "filemode = false\n" # the file mode
+            "bare = false\n" # the bare flag
+            "\n")
 
 # init command
 argsp = argsubparsers.add_parser('init', help='Initialize a new, empty repository.')
@@ -164,27 +280,55 @@ argsp.add_argument('path',
 def cmd_init(args):
     repo_create(args.path)
 
+argsp.set_defaults(func=cmd_init)
+
 # repository find function (to find the root of the current repository)
+
+# every directory we've walked through, and the repository it belongs to
+# (or None if it isn't in one): {path: GitRepository}
+repo_find_cache = dict()
+
 def repo_find(path=".", required=True):
+    # path is made canonical once, so walking up with dirname (a pure
+    # string operation) keeps it canonical: no need to realpath every level.
     path = os.path.realpath(path) # get the real path
 
-    if os.path.isdir(os.path.join(path, ".git")): # if the .git directory exists
-        return GitRepository(path) # return the repository
+    visited = list() # directories we had no answer for
+    while True:
+        # Did an earlier call already walk through here?
+        if path in repo_find_cache:
+            repo = repo_find_cache[path]
+            break
+
+        visited.append(path)
+        try:
+            is_repo = S_ISDIR(os.stat(os.path.join(path, ".git")).st_mode) # does the .git directory exist?
+        except OSError: # missing, or in a directory we can't search: not a repository, like os.path.isdir says
+            is_repo = False
+
+        if is_repo:
+            repo = GitRepository(path)
+            break
+
+        # If we haven't found it, try the parent
+        parent = os.path.dirname(path)
 
-    # If we haven't returned, recurse in parent, if w
-    parent = os.path.realpath(os.path.join(path, ".."))
+        if parent == path:
+            # os.path.dirname("/") == "/":
+            # If parent==path, then path is root.
+            repo = None
+            break
 
-    if parent == path:
-        # Bottom case
-        # os.path.join("/", "..") == "/":
-        # If parent==path, then path is root.
-        if required: # if required is True
-            raise Exception("No git directory.") # raise an exception
-        else: # otherwise
-            return None # return None
+        path = parent
 
-    # Recursive case
-    return repo_find(parent, required) # find the repository in the parent directory
+    # Everything we walked through belongs to the same repository: the
+    # next lookup from any of these directories is a single dict access.
+    for p in visited:
+        repo_find_cache[p] = repo
+
+    if repo is None and required: # if required is True
+        raise Exception("No git directory.") # raise an exception
+    return repo # return the repository (or None)
 
 ############################################################################################
 #---------------------------------- HASH OBJECT & CAT FILE --------------------------------#
@@ -214,40 +358,228 @@ class GitObject(object): # base class for all git objects (a generic object obje
 def object_read(repo, sha): # read an object from the repository
     """Read object sha from Git repository repo.  Return a
     GitObject whose exact type depends on the object."""
-
-    path = repo_file(repo, "objects", sha[0:2], sha[2:]) # get the path of the object
-
-    if not os.path.isfile(path): # if the object does not exist
-        return None # return None
-
-    with open (path, "rb") as f: # open the object file
-        raw = zlib.decompress(f.read()) # read the object file and decompress it
+    key = (repo.gitdir, repo.objects_id, sha) # (objects_id tells a recreated repository from the old one)
+    with object_cache_lock:
+        obj = object_cache.get(key)
+        if obj is not None:
+            object_cache.move_to_end(key)
+
+    if obj is None:
+        try:
+            obj = object_read_file(repo.gitdir, sha)
+        except FileNotFoundError: # if the object does not exist
+            return None # return None (misses are not cached, the object may be written later)
+        if obj.fmt == b'blob':
+            return obj
+        with object_cache_lock:
+            object_cache[key] = obj
+            if len(object_cache) > object_cache_max:
+                object_cache.popitem(last=False) # drop the least recently used
+
+    # Callers may change what they get (tree_serialize sorts the items):
+    # give them a copy, so the cached object stays as read.
+    return obj.copy()
+
+# .git/objects is opened once per process, and every object is then
+# opened relative to it instead of walking the full path from / again.
+objects_fds = dict() # {gitdir: fd of gitdir/objects}
+objects_fds_lock = threading.Lock() # objects are read from several threads
+
+def objects_dir_fd(gitdir):
+    with objects_fds_lock:
+        fd = objects_fds.get(gitdir)
+        if fd is None:
+            fd = os.open(os.path.join(gitdir, "objects"), os.O_RDONLY | os.O_DIRECTORY)
+            objects_fds[gitdir] = fd
+        return fd
+
+def objects_dir_close(gitdir=None):
+    """Close the objects directory we hold open for gitdir (or for all
+    repositories), so the next access opens it again."""
+    with objects_fds_lock:
+        for d in ([ gitdir ] if gitdir else list(objects_fds)):
+            fd = objects_fds.pop(d, None)
+            if fd is not None:
+                os.close(fd)
+
+def object_open(gitdir, sha):
+    """Open the file of loose object sha, and return its fd."""
+    # open the object relative to .git/objects: the kernel only resolves two path components
+    name = sha[0:2] + "/" + sha[2:]
+    try:
+        return os.open(name, os.O_RDONLY, dir_fd=objects_dir_fd(gitdir))
+    except FileNotFoundError:
+        # The directory we hold open may not be gitdir/objects anymore:
+        # the repository may have been deleted, and created again at the
+        # same path.  If so, open the new one and try again.
+        held = os.fstat(objects_dir_fd(gitdir))
+        try:
+            st = os.stat(os.path.join(gitdir, "objects"))
+        except FileNotFoundError:
+            st = None
+        if st and (st.st_dev, st.st_ino) == (held.st_dev, held.st_ino):
+            raise # same directory: the object really isn't there
+        objects_dir_close(gitdir)
+        return os.open(name, os.O_RDONLY, dir_fd=objects_dir_fd(gitdir))
+
+# Objects are immutable (their name is the hash of their contents), so
+# once parsed an object never needs to be read again.  log, ls-tree and
+# status touch the same commits and trees over and over.  Only those
+# (and tags) are cached: they're small, while blobs can be any size and
+# are rarely read twice.
+object_cache = collections.OrderedDict() # {(gitdir, objects_id, sha): GitObject}, least recently used first
+object_cache_max = 4096
+object_cache_lock = threading.Lock()
+
+def object_cache_clear():
+    with object_cache_lock:
+        object_cache.clear()
+
+def object_read_file(gitdir, sha):
+    fd = object_open(gitdir, sha)
+
+    with os.fdopen(fd, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm: # map the object file
+        raw = zlib.decompress(mm) # decompress it straight from the mapping, without reading it in a buffer first
 
         # Read object type
-        x = raw.find(b' ') # find the first space
+        # (index, unlike find, raises on a missing separator instead of
+        # returning -1 and letting us slice garbage)
+        x = raw.index(b' ') # find the first space
         fmt = raw[0:x] # get the object type
 
         # Read and validate object size
-        y = raw.find(b'\x00', x) # find the first null byte
+        y = raw.index(b'\x00', x) # find the first null byte
         size = int(raw[x:y].decode("ascii")) # get the object size
         if size != len(raw)-y-1: # if the size is not equal to the length of the object
             raise Exception("Malformed object {0}: bad length".format(sha)) # raise an exception
 
         # Pick constructor
-        if fmt == b'commit':
-            c = GitCommit # if the object is a commit
-        elif fmt == b'tree':
-            c = GitTree # if the object is a tree
-        elif fmt == b'tag':
-            c = GitTag # if the object is a tag
-        elif fmt == b'blob':
-            c = GitBlob # if the object is a blob
-        else:
-            raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha)) # raise an exception    
+        c = object_constructors.get(fmt) # one dict lookup instead of a chain of comparisons
+        if c is None:
+            raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha)) # raise an exception
 
         # Call constructor and return object
+        # Blobs keep a view on the decompressed data instead of a copy of
+        # it; the other types are parsed, and their parsers want bytes.
+        if c == GitBlob:
+            return c(memoryview(raw)[y+1:])
         return c(raw[y+1:])
-    
+
+# Object type only
+# Some callers (object_find) only want to know what kind of object a
+# sha names.  The type is in the first few bytes of the decompressed
+# data, so there is no need to inflate (or parse) the rest of it.
+def object_peek_fmt(repo, sha):
+    """Return the type of object sha in repo, or None if it does not exist."""
+    try:
+        fd = object_open(repo.gitdir, sha)
+    except FileNotFoundError:
+        return None
+
+    with os.fdopen(fd, "rb") as f:
+        d = zlib.decompressobj()
+        head = b''
+        # The header ("fmt size\x00") fits in 32 bytes; a first read of
+        # 64 compressed bytes is almost always enough to produce it.
+        while b' ' not in head:
+            data = d.unconsumed_tail or f.read(64)
+            if not data:
+                raise Exception("Malformed object {0}: no header".format(sha))
+            head += d.decompress(data, 32 - len(head))
+            if len(head) >= 32 and b' ' not in head:
+                raise Exception("Malformed object {0}: no header".format(sha))
+
+    fmt = head[0:head.index(b' ')]
+    if fmt not in object_constructors:
+        raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+    return fmt
+
+# worker threads
+# zlib and hashlib release the GIL while they work on a buffer, so
+# decompressing, compressing or hashing many objects from a pool of
+# threads really does run in parallel.
+pool = None # created on first use
+
+def thread_pool():
+    global pool
+    if pool is None:
+        # imported here: concurrent.futures (and the logging module it
+        # pulls in) costs more to import than most commands take to run
+        import concurrent.futures
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+    return pool
+
+def temp_suffix():
+    """A suffix for temporary files that no other process or thread will use."""
+    return ".tmp.{}.{}".format(os.getpid(), threading.get_ident())
+
+# reading many objects
+def object_read_many(repo, shas):
+    """Read all objects shas from repo, and return an iterator over them,
+    in the same order as shas."""
+    shas = list(shas)
+
+    if len(shas) < 2: # nothing to parallelize
+        return (object_read(repo, sha) for sha in shas)
+
+    return thread_pool().map(lambda sha: object_read(repo, sha), shas)
+
+# streaming objects
+# object_read returns the whole object in memory, which for a big blob
+# means holding both the compressed file and the decompressed data.  When
+# all we want is to copy the contents somewhere (cat-file), we can
+# decompress a chunk at a time and write it out as we go.
+def object_inflate(mm, chunk_size):
+    """Decompress the buffer mm, yielding at most chunk_size bytes at a time."""
+    d = zlib.decompressobj()
+    for pos in range(0, len(mm), chunk_size):
+        data = mm[pos:pos+chunk_size]
+        while data:
+            yield d.decompress(data, chunk_size)
+            data = d.unconsumed_tail # whatever didn't fit in chunk_size bytes of output
+    yield d.flush()
+
+def object_stream(repo, sha, out, chunk_size=1 << 16):
+    """Write the contents of object sha (without header) to the binary file out.
+    Return the object type."""
+    fd = object_open(repo.gitdir, sha)
+
+    with os.fdopen(fd, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        chunks = object_inflate(mm, chunk_size)
+
+        # Read the header ("fmt size\x00"), which may span several chunks
+        head = b''
+        while b'\x00' not in head:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise Exception("Malformed object {0}: no header".format(sha))
+            head += chunk
+        y = head.index(b'\x00')
+        x = head.index(b' ')
+        fmt = head[0:x]
+        size = int(head[x:y].decode("ascii"))
+        if fmt not in object_constructors:
+            raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+
+        # Then copy everything else, checking the size as we go
+        body = head[y+1:]
+        written = len(body)
+        out.write(body)
+        for chunk in chunks:
+            written += len(chunk)
+            out.write(chunk)
+
+    if size != written:
+        raise Exception("Malformed object {0}: bad length".format(sha))
+    return fmt
+
+# SHA-1
+# hashlib already uses OpenSSL's SHA-1 when Python is built with it.
+# Object ids are content addresses, not a security measure: passing
+# usedforsecurity=False keeps FIPS-mode OpenSSL builds from rejecting
+# or rerouting it.
+sha1_new = functools.partial(hashlib.sha1, usedforsecurity=False)
+
 # writing objects
 # writing an object is reading it in reverse
 # 1. compute the object's hash
@@ -255,29 +587,101 @@ def object_read(repo, sha): # read an object from the repository
 # 3. zlib-compress everything
 # 4. write the result in the correct location
 def object_write(obj, repo=None):
-    # Serialize object data
-    data = obj.serialize()
-    # Add header
-    result = obj.fmt + b' ' + str(len(data)).encode() + b'\x00' + data
-    # Compute hash
-    sha = hashlib.sha1(result).hexdigest()
-
-    if repo:
-        # Compute path
-        path=repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
-
+    # Serialize object data, and write it
+    return object_write_data(obj.fmt, obj.serialize(), repo)
+
+def object_write_data(fmt, data, repo=None, chunk_size=1 << 16):
+    """Write data, already serialized, as an object of type fmt.  Callers
+    holding raw bytes use this directly instead of wrapping them in a
+    GitObject just to have them serialized back."""
+    # Hash the header, then the data: no need to build header + data in memory
+    header = fmt + b' ' + str(len(data)).encode() + b'\x00'
+    h = sha1_new(header)
+
+    if not repo:
+        h.update(data)
+        return h.hexdigest()
+
+    if len(data) <= chunk_size:
+        # Small object: hash it first, so we don't compress objects we already have
+        h.update(data)
+        sha = h.hexdigest()
+        path = object_path(repo, sha, mkdir=True)
         if not os.path.exists(path):
-            with open(path, 'wb') as f:
-                # Compress and write
-                f.write(zlib.compress(result))
+            # Compress and write
+            co = zlib.compressobj(repo_compression_level(repo))
+            object_file_write(path, (co.compress(header), co.compress(data), co.flush()))
+        return sha
+
+    # Big object: hash and compress each chunk while it's still in the CPU
+    # cache, instead of going through the whole object twice (once to hash
+    # it, once to compress it).
+    view = memoryview(data)
+    return object_write_chunks(repo, header, (view[pos:pos+chunk_size] for pos in range(0, len(view), chunk_size)))
+
+def object_write_chunks(repo, header, chunks):
+    """Write an object made of header followed by the chunks, hashing and
+    compressing each chunk in turn.  The compressed data goes straight to a
+    temporary file, which is moved in place once the hash, and thus the
+    object's path, is known.  Return the object's hash."""
+    h = sha1_new(header)
+    co = zlib.compressobj(repo_compression_level(repo))
+    tmp = os.path.join(repo_dir(repo, "objects", mkdir=True), "tmp_obj" + temp_suffix())
+    try:
+        with open(tmp, "wb") as out:
+            out.write(co.compress(header))
+            for chunk in chunks:
+                h.update(chunk)
+                out.write(co.compress(chunk))
+            out.write(co.flush())
+
+        sha = h.hexdigest()
+        path = object_path(repo, sha, mkdir=True)
+        if os.path.exists(path): # we already had it
+            os.unlink(tmp)
+        else:
+            os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
     return sha
 
+def repo_compression_level(repo):
+    """zlib level for loose objects.  Like git, this is core.looseCompression,
+    or core.compression, or 1: loose objects are written often and
+    repacked later, so speed matters more than size (level 1 is about 3x
+    faster than zlib's default, for files only slightly bigger)."""
+    level = repo.conf.get("core", "looseCompression", fallback=None)
+    if level is None:
+        level = repo.conf.get("core", "compression", fallback=None)
+    return int(level) if level is not None else 1
+
+def object_file_write(path, chunks):
+    """Write the compressed object chunks to path.  We write to a temporary
+    file first, then rename it in place: the rename is atomic, so a
+    crash can't leave a truncated object behind for object_read to choke on.
+    The temporary file is objects/tmp_obj*, like in object_write_chunks:
+    next to the object, its name would start with the object's, and a
+    leftover one would make the object's hash look ambiguous."""
+    tmp = os.path.join(os.path.dirname(os.path.dirname(path)), "tmp_obj" + temp_suffix())
+    try:
+        with open(tmp, 'wb') as f:
+            f.writelines(chunks)
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
 # working with blobs (git has 4 object types: commit, tree, tag, and blob)
 # blobs are the simplest objects (because they have no actual format)
 # they are user data (all the files are stored as blobs)
 
 class GitBlob(GitObject):
     fmt=b'blob'
+    # blobdata is any bytes-like object: bytes, or a memoryview when read from the store
 
     def serialize(self):
         return self.blobdata
@@ -302,9 +706,11 @@ def cmd_cat_file(args):
     repo = repo_find()
     cat_file(repo, args.object, fmt=args.type.encode())
 
+argsp.set_defaults(func=cmd_cat_file)
+
 def cat_file(repo, obj, fmt=None):
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
-    sys.stdout.buffer.write(obj.serialize())
+    # stream the object rather than reading it whole: blobs can be big
+    object_stream(repo, object_find(repo, obj, fmt=fmt), sys.stdout.buffer)
 
 def object_find(repo, name, fmt=None, follow=True):
     return name
@@ -327,35 +733,231 @@ argsp.add_argument("-w",
                    help="Actually write the object into the database")
 
 argsp.add_argument("path",
+                   nargs="+",
                    help="Read object from <file>")
 
 def cmd_hash_object(args):
+    # Only writing needs a repository: plain hashing works on any file,
+    # and doesn't touch (or even look for) a repository.  When writing,
+    # we reuse (and update) the repository's hash cache.
     if args.write:
         repo = repo_find()
+        cache = hashcache_read(repo)
     else:
         repo = None
+        cache = None
 
-    with open(args.path, "rb") as fd:
-        sha = object_hash(fd, args.type.encode(), repo)
+    for sha in object_hash_many(args.path, args.type.encode(), repo, cache):
         print(sha)
 
-def object_hash(fd, fmt, repo=None):
-    """ Hash object, writing it to repo if provided."""
+    if cache:
+        hashcache_write(cache)
+
+argsp.set_defaults(func=cmd_hash_object)
+
+def object_hash(fd, fmt, repo=None, cache=None):
+    """ Hash object, writing it to repo if provided.  For blobs, cache is
+    an optional GitHashCache used to skip rehashing unchanged files."""
+    # Blobs can be arbitrarily large, so we never load them in memory
+    if fmt == b'blob':
+        st = os.fstat(fd.fileno())
+        # Only a regular file's stat tells us whether it changed
+        if not cache or not S_ISREG(st.st_mode):
+            return blob_hash_stream(fd, repo)
+
+        sha = hashcache_get(cache, fd.name, st)
+        # A hit is enough when we're only hashing, but when writing the
+        # object must also be in the store.
+        if sha and not (repo and not os.path.exists(object_path(repo, sha))):
+            return sha
+
+        sha = blob_hash_stream(fd, repo)
+        hashcache_set(cache, fd.name, st, sha)
+        return sha
+
+    # Other objects are small, the in-memory path is fine
     data = fd.read()
 
-    # Choose constructor according to fmt argument
-    if fmt == b'commit':
-        obj = GitCommit(data)
-    elif fmt == b'tree':
-        obj = GitTree(data)
-    elif fmt == b'tag':
-        obj = GitTag(data)
-    elif fmt == b'blob':
-        obj = GitBlob(data)
-    else:
+    if fmt not in object_constructors:
         raise Exception("Unknown type %s!" % fmt)
 
-    return object_write(obj, repo)
+    # The file already holds the serialized object: hash it as is, there's
+    # no need to parse it into a GitObject only to serialize it back.
+    return object_write_data(fmt, data, repo)
+
+# blob hash cache
+# Hashing a file means reading all of it.  If we hashed it before and it
+# hasn't changed since, the result can be reused.  Like git's index, we
+# tell that it hasn't changed by comparing its whole stat "stamp":
+# mtime, ctime, size, inode and device.  mtime and size alone miss
+# same-size edits that keep the old mtime (cp -p, rsync -t, tar x,
+# touch -d); those still change the ctime, or the inode.
+# The cache is stored in .git/owngit-hashcache: a header ("OGHC" and a
+# 4-byte version, 2), then fixed-size records:
+#   32 bytes  SHA-256 of the file's absolute path
+#    8 bytes  mtime, in nanoseconds
+#    8 bytes  ctime, in nanoseconds
+#    8 bytes  size
+#    8 bytes  inode
+#    8 bytes  device
+#   20 bytes  SHA-1 of the blob
+hashcache_header = b"OGHC" + (2).to_bytes(4, "big")
+hashcache_record = struct.Struct(">32s5Q20s")
+
+class GitHashCache(object):
+    path = None # the cache file
+    entries = None # {path_hash: (stamp, sha)}, see hashcache_stamp
+    written = 0 # when the file was last written (its mtime, in nanoseconds)
+    dirty = False # whether entries changed since the file was read
+
+    def __init__(self, path, entries=None):
+        if not entries:
+            entries = dict()
+
+        self.path = path
+        self.entries = entries
+
+def hashcache_read(repo):
+    path = repo_path(repo, "owngit-hashcache")
+    cache = GitHashCache(path)
+
+    try:
+        with open(path, "rb") as f:
+            cache.written = os.fstat(f.fileno()).st_mtime_ns
+            raw = f.read()
+    except OSError: # missing, or not ours to read
+        return cache
+
+    # A cache in another format (or a damaged one) is simply ignored,
+    # and replaced next time we write.
+    if not raw.startswith(hashcache_header):
+        return cache
+
+    end = len(raw) - (len(raw) - len(hashcache_header)) % hashcache_record.size
+    for (key, mtime, ctime, size, ino, dev, sha) in hashcache_record.iter_unpack(raw[len(hashcache_header):end]):
+        cache.entries[key] = ((mtime, ctime, size, ino, dev), sha.hex())
+
+    return cache
+
+def hashcache_write(cache):
+    if not cache.dirty:
+        return
+
+    parts = [ hashcache_header ]
+    for key, (stamp, sha) in cache.entries.items():
+        parts.append(hashcache_record.pack(key, *stamp, bytes.fromhex(sha)))
+
+    # Write to a temporary file first, so a concurrent reader never sees half a cache
+    # The cache is only an optimization: if we can't write it (a .git we
+    # don't own, a read-only mount), carry on without it, as git does
+    # when it can't refresh the index in status.
+    tmp = cache.path + temp_suffix()
+    try:
+        with open(tmp, "wb") as f:
+            f.write(b''.join(parts))
+        os.replace(tmp, cache.path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        return
+    cache.dirty = False
+
+def hashcache_key(path):
+    return hashlib.sha256(os.path.abspath(path).encode("utf8"), usedforsecurity=False).digest()
+
+def hashcache_stamp(st):
+    return (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino, st.st_dev)
+
+def hashcache_get(cache, path, st):
+    entry = cache.entries.get(hashcache_key(path))
+    if not entry or entry[0] != hashcache_stamp(st):
+        return None
+    # "Racy" entries: a file modified in the same timestamp tick as the
+    # cache was written could have changed after it was hashed without
+    # its stamp showing it.  Those are rehashed, as git does.
+    if st.st_mtime_ns >= cache.written:
+        return None
+    return entry[1]
+
+def hashcache_set(cache, path, st, sha):
+    key = hashcache_key(path)
+
+    # A file modified in the last couple of seconds could be modified
+    # again without its mtime changing (coarse filesystem timestamps), so
+    # we can't trust a hash taken now to still be valid later.  Nor any
+    # older entry for it.
+    if time.time_ns() - st.st_mtime_ns < 2 * 10**9:
+        if cache.entries.pop(key, None):
+            cache.dirty = True
+        return
+
+    cache.entries[key] = (hashcache_stamp(st), sha)
+    cache.dirty = True
+
+def object_hash_many(paths, fmt, repo=None, cache=None):
+    """Hash the files at paths, like object_hash.  Return an iterator over
+    their hashes, in the same order as paths.
+
+    With many small files, the time goes into opening and reading them one
+    after the other, not into SHA-1: the files are hashed from the thread
+    pool so the I/O and the hashing overlap."""
+    def hash_one(path):
+        with open(path, "rb") as fd:
+            return object_hash(fd, fmt, repo, cache)
+
+    if len(paths) < 2: # nothing to parallelize
+        return map(hash_one, paths)
+
+    return thread_pool().map(hash_one, paths)
+
+def blob_hash_stream(fd, repo=None, chunk_size=1 << 20):
+    """Hash the file fd as a blob, writing it to repo if provided.
+
+    The file is read chunk_size bytes at a time, and each chunk is fed to
+    both SHA-1 and zlib, so memory use doesn't depend on the file size."""
+    st = os.fstat(fd.fileno())
+
+    # The header needs the size up front, and only a regular file's stat
+    # gives it (pipes and FIFOs say 0).  Anything else is read in memory
+    # first, like any other object.
+    if not S_ISREG(st.st_mode):
+        return object_write_data(b'blob', fd.read(), repo)
+
+    size = st.st_size
+    header = b'blob ' + str(size).encode() + b'\x00'
+    h = sha1_new(header)
+
+    # The header was written from stat, so the file mustn't have changed under us.
+    def check(read):
+        if read != size:
+            raise Exception("File changed while hashing: expected {} bytes, read {}".format(size, read))
+
+    if not repo:
+        if hasattr(hashlib, "file_digest"): # Python 3.11+
+            # file_digest reads into one reusable buffer and feeds it to
+            # the hash from C: no bytes object per chunk.  It creates
+            # the hash object itself, so give it the one holding the header.
+            start = fd.tell()
+            digest = hashlib.file_digest(fd, lambda: h).hexdigest()
+            check(fd.tell() - start)
+            return digest
+        read = 0
+        while chunk := fd.read(chunk_size):
+            read += len(chunk)
+            h.update(chunk)
+        check(read)
+        return h.hexdigest()
+
+    def chunks():
+        read = 0
+        while chunk := fd.read(chunk_size):
+            read += len(chunk)
+            yield chunk
+        check(read)
+
+    return object_write_chunks(repo, header, chunks())
 
 ############################################################################################
 #---------------------------------- READING COMMIT HISTORY: LOG ---------------------------#
@@ -374,57 +976,52 @@ def kvlm_parse(raw, start=0, dct=None): # key-value list with message
         # You CANNOT declare the argument as dct=OrderedDict() or all
         # call to the functions will endlessly grow the same dict.
 
-    # This function is recursive: it reads a key/value pair, then call
-    # itself back with the new position.  So we first need to know
-    # where we are: at a keyword, or already in the messageQ
-
-    # We search for the next space and the next newline.
-    spc = raw.find(b' ', start)
-    nl = raw.find(b'\n', start)
-
-    # If space appears before newline, we have a keyword.  Otherwise,
-    # it's the final message, which we just read to the end of the file.
-
-    # Base case
-    # =========
-    # If newline appears first (or there's no space at all, in which
-    # case find returns -1), we assume a blank line.  A blank line
-    # means the remainder of the data is the message.  We store it in
-    # the dictionary, with None as the key, and return.
-    if (spc < 0) or (nl < spc):
-        assert nl == start
-        dct[None] = raw[start+1:]
-        return dct
-
-    # Recursive case
-    # ==============
-    # we read a key-value pair and recurse for the next.
-    key = raw[start:spc]
-
-    # Find the end of the value.  Continuation lines begin with a
-    # space, so we loop until we find a "\n" not followed by a space.
-    end = start
-    while True:
-        end = raw.find(b'\n', end+1)
-        if raw[end+1] != ord(' '): break
-
-    # Grab the value
-    # Also, drop the leading space on continuation lines
-    value = raw[spc+1:end].replace(b'\n ', b'\n')
-
-    # Don't overwrite existing data contents
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
-        else:
-            dct[key] = [ dct[key], value ]
+    # The headers end at the first blank line: everything after it is
+    # the message.  (Continuation lines begin with a space, so they are
+    # never blank.)  We find it once, so that the searches below never
+    # look past the headers.
+    if raw.startswith(b'\n', start):
+        header_end = start
     else:
-        dct[key]=value
+        header_end = raw.index(b'\n\n', start) + 1
+
+    # Read key-value pairs, one per iteration, until we reach the blank line.
+    while start < header_end:
+        # The key runs up to the first space.
+        spc = raw.index(b' ', start, header_end)
+        key = raw[start:spc]
+
+        # Find the end of the value.  Continuation lines begin with a
+        # space, so we loop until we find a "\n" not followed by a space.
+        end = raw.index(b'\n', spc)
+        while raw[end+1] == ord(' '):
+            end = raw.index(b'\n', end+1)
+
+        # Grab the value
+        # Also, drop the leading space on continuation lines (if there are any)
+        value = raw[spc+1:end]
+        if b'\n ' in value:
+            value = value.replace(b'\n ', b'\n')
+
+        # Don't overwrite existing data contents
+        if key in dct:
+            if type(dct[key]) == list:
+                dct[key].append(value)
+            else:
+                dct[key] = [ dct[key], value ]
+        else:
+            dct[key]=value
+
+        start = end + 1
 
-    return kvlm_parse(raw, start=end+1, dct=dct)
+    # The blank line itself isn't part of the message.  We store the
+    # message in the dictionary, with None as the key.
+    dct[None] = raw[header_end+1:]
+    return dct
 
 def kvlm_serialize(kvlm):
-    ret = b''
+    # Collect the pieces, and join them once at the end
+    parts = list()
 
     # Output fields
     for k in kvlm.keys():
@@ -436,12 +1033,12 @@ def kvlm_serialize(kvlm):
             val = [ val ]
 
         for v in val:
-            ret += k + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
+            parts.extend((k, b' ', v.replace(b'\n', b'\n '), b'\n'))
 
     # Append message
-    ret += b'\n' + kvlm[None] + b'\n'
+    parts.extend((b'\n', kvlm[None], b'\n'))
 
-    return 
+    return b''.join(parts)
 
 # commit object
 class GitCommit(GitObject):
@@ -456,6 +1053,12 @@ class GitCommit(GitObject):
     def init(self):
         self.kvlm = dict()
 
+    def copy(self):
+        c = self.__class__()
+        c.kvlm = collections.OrderedDict((k, list(v) if type(v) == list else v)
+                                         for k, v in self.kvlm.items())
+        return c
+
 # log command
 argsp = argsubparsers.add_parser("log", help="Display history of a given commit.")
 argsp.add_argument("commit",
@@ -471,37 +1074,51 @@ def cmd_log(args):
     log_graphviz(repo, object_find(repo, args.commit), set())
     print("}")
 
+argsp.set_defaults(func=cmd_log)
+
 def log_graphviz(repo, sha, seen):
+    # Walk the history with an explicit stack rather than recursion, so
+    # long histories don't run into Python's recursion limit.  The stack
+    # holds commits to visit and edges to print, pushed in reverse so
+    # they come out in the same (depth-first) order as before.
+    stack = [ sha ]
 
-    if sha in seen:
-        return
-    seen.add(sha)
+    while stack:
+        sha = stack.pop()
 
-    commit = object_read(repo, sha)
-    short_hash = sha[0:8]
-    message = commit.kvlm[None].decode("utf8").strip()
-    message = message.replace("\\", "\\\\")
-    message = message.replace("\"", "\\\"")
+        if type(sha) == tuple: # an edge
+            print ("  c_{0} -> c_{1};".format(*sha))
+            continue
 
-    if "\n" in message: # Keep only the first line
-        message = message[:message.index("\n")]
+        if sha in seen:
+            continue
+        seen.add(sha)
 
-    print("  c_{0} [label=\"{1}: {2}\"]".format(sha, sha[0:7], message))
-    assert commit.fmt==b'commit'
+        commit = object_read(repo, sha)
+        short_hash = sha[0:8]
+        message = commit.kvlm[None].decode("utf8").strip()
+        message = message.replace("\\", "\\\\")
+        message = message.replace("\"", "\\\"")
 
-    if not b'parent' in commit.kvlm.keys():
-        # Base case: the initial commit.
-        return
+        if "\n" in message: # Keep only the first line
+            message = message[:message.index("\n")]
+
+        print("  c_{0} [label=\"{1}: {2}\"]".format(sha, sha[0:7], message))
+        assert commit.fmt==b'commit'
 
-    parents = commit.kvlm[b'parent']
+        if not b'parent' in commit.kvlm.keys():
+            # Base case: the initial commit.
+            continue
+
+        parents = commit.kvlm[b'parent']
 
-    if type(parents) != list:
-        parents = [ parents ]
+        if type(parents) != list:
+            parents = [ parents ]
 
-    for p in parents:
-        p = p.decode("ascii")
-        print ("  c_{0} -> c_{1};".format(sha, p))
-        log_graphviz(repo, p, seen)
+        for p in reversed(parents):
+            p = p.decode("ascii")
+            stack.append(p)
+            stack.append((sha, p))
 
 ############################################################################################
 #---------------------------------- READING COMMIT DATA: CHECKOUT -------------------------#
@@ -513,33 +1130,32 @@ class GitTreeLeaf (object):
         self.path = path
         self.sha = sha
 
-def tree_parse_one(raw, start=0):
-    # Find the space terminator of the mode
-    x = raw.find(b' ', start)
-    assert x-start == 5 or x-start==6
-
-    # Read the mode
-    mode = raw[start:x]
-    if len(mode) == 5:
-        # Normalize to six bytes.
-        mode = b" " + mode
-
-    # Find the NULL terminator of the path
-    y = raw.find(b'\x00', x)
-    # and read the path
-    path = raw[x+1:y]
-
-    # Read the SHA and convert to a hex string
-    sha = format(int.from_bytes(raw[y+1:y+21], "big"), "040x")
-    return y+21, GitTreeLeaf(mode, path.decode("utf8"), sha)
+# A tree entry is "<mode> <path>\x00<20 bytes of SHA>".  Matching a whole
+# entry with one compiled regex lets the regex engine (C code) do the
+# scanning, instead of several find() calls and slices from Python.
+tree_entry_re = re.compile(rb'([0-7]{5,6}) ([^\x00]*)\x00(.{20})', re.S)
 
 def tree_parse(raw):
+    # Trees can have thousands of entries: the loop is kept tight, with
+    # the match method looked up once and no function call per entry.
     pos = 0
     max = len(raw)
     ret = list()
+    match = tree_entry_re.match
     while pos < max:
-        pos, data = tree_parse_one(raw, pos)
-        ret.append(data)
+        m = match(raw, pos)
+        if not m:
+            raise Exception("Malformed tree entry at offset {}".format(pos))
+        mode, path, sha = m.groups()
+
+        if len(mode) == 5:
+            # Normalize to six bytes.
+            mode = b" " + mode
+
+        # Convert the SHA to a hex string (bytes.hex is done in C, no need to
+        # go through a 160-bit integer)
+        ret.append(GitTreeLeaf(mode, path.decode("utf8"), sha.hex()))
+        pos = m.end()
 
     return ret
 
@@ -555,16 +1171,14 @@ def tree_leaf_sort_key(leaf):
         return leaf.path + "/"
 
 def tree_serialize(obj):
+    # sort() computes each leaf's key once, up front (not once per
+    # comparison), so sorting costs O(n) key allocations.
     obj.items.sort(key=tree_leaf_sort_key)
-    ret = b''
-    for i in obj.items:
-        ret += i.mode
-        ret += b' '
-        ret += i.path.encode("utf8")
-        ret += b'\x00'
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder="big")
-    return ret
+    # Build each entry in one expression and join them all at the end:
+    # a single allocation for the result, instead of growing it five
+    # times per entry.
+    return b''.join([i.mode + b' ' + i.path.encode("utf8") + b'\x00' + bytes.fromhex(i.sha)
+                     for i in obj.items])
     
 class GitTree(GitObject):
     fmt=b'tree'
@@ -578,6 +1192,11 @@ class GitTree(GitObject):
     def init(self):
         self.items = list()
 
+    def copy(self):
+        c = GitTree()
+        c.items = list(self.items)
+        return c
+
 argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object.")
 argsp.add_argument("-r",
                    dest="recursive",
@@ -591,6 +1210,8 @@ def cmd_ls_tree(args):
     repo = repo_find()
     ls_tree(repo, args.tree, args.recursive)
 
+argsp.set_defaults(func=cmd_ls_tree)
+
 def ls_tree(repo, ref, recursive=None, prefix=""):
     sha = object_find(repo, ref, fmt=b"tree")
     obj = object_read(repo, sha)
@@ -647,18 +1268,46 @@ def cmd_checkout(args):
 
     tree_checkout(repo, obj, os.path.realpath(args.path))
 
+argsp.set_defaults(func=cmd_checkout)
+
 def tree_checkout(repo, tree, path):
-    for item in tree.items:
-        obj = object_read(repo, item.sha)
-        dest = os.path.join(path, item.path)
+    # Subtrees go on a work queue instead of being checked out
+    # recursively, and files are written from the thread pool, so
+    # writing one file overlaps with decompressing the next ones.
+    work = collections.deque([ (tree, path) ])
+    writes = list()
+
+    while work:
+        tree, path = work.popleft()
+
+        # The mode tells us which entries are trees: only those need to be
+        # read (in parallel, in tree order).  Blobs are streamed from the
+        # object file straight to their destination, without ever holding
+        # their whole contents in memory.
+        subtrees = list()
+        for item in tree.items:
+            dest = os.path.join(path, item.path)
+
+            if S_ISDIR(int(item.mode, 8)):
+                os.mkdir(dest)
+                subtrees.append((item.sha, dest))
+            else:
+                # @TODO Support symlinks (identified by mode 12****)
+                writes.append(thread_pool().submit(blob_checkout, repo, item.sha, dest))
+
+        for (sha, dest), obj in zip(subtrees, object_read_many(repo, [sha for sha, _ in subtrees])):
+            work.append((obj, dest))
 
-        if obj.fmt == b'tree':
-            os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
-            # @TODO Support symlinks (identified by mode 12****)
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+    # wait for the writes, and raise the first error if any failed
+    for w in writes:
+        w.result()
+
+def blob_checkout(repo, sha, path):
+    """Write the contents of blob sha to a new file at path."""
+    with open(path, 'wb') as f:
+        fmt = object_stream(repo, sha, f)
+        if fmt != b'blob':
+            raise Exception("Object {0} is a {1}, not a blob".format(sha, fmt.decode("ascii")))
 
 
 ############################################################################################
@@ -666,37 +1315,72 @@ def tree_checkout(repo, tree, path):
 ############################################################################################
 
 # references
-def ref_resolve(repo, ref):
-    path = repo_file(repo, ref)
-
-    # Sometimes, an indirect reference may be broken.  This is normal
-    # in one specific case: we're looking for HEAD on a new repository
-    # with no commits.  In that case, .git/HEAD points to "ref:
-    # refs/heads/main", but .git/refs/heads/main doesn't exist yet
-    # (since there's no commit for it to refer to).
-    if not os.path.isfile(path):
-        return None
+def ref_resolve(repo, ref, cache=None):
+    """Resolve ref to a sha, following symbolic refs.  cache is an
+    optional dict of already resolved refs: HEAD and the branches
+    often point to the same targets."""
+    chain = list()
 
-    with open(path, 'r') as fp:
-        data = fp.read()[:-1]
-        # Drop final \n ^^^^^
-    if data.startswith("ref: "):
-        return ref_resolve(repo, data[5:])
-    else:
-        return data
+    while True:
+        if cache is not None and ref in cache:
+            data = cache[ref]
+            break
+
+        if ref in chain:
+            raise Exception("Reference loop: {0}".format(" -> ".join(chain + [ ref ])))
+        chain.append(ref)
+
+        # Sometimes, an indirect reference may be broken.  This is normal
+        # in one specific case: we're looking for HEAD on a new repository
+        # with no commits.  In that case, .git/HEAD points to "ref:
+        # refs/heads/main", but .git/refs/heads/main doesn't exist yet
+        # (since there's no commit for it to refer to).
+        try:
+            with open(repo_path(repo, ref), 'r') as fp:
+                data = fp.read()[:-1]
+                # Drop final \n ^^^^^
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            data = None
+            break
 
-def ref_list(repo, path=None):
+        if not data.startswith("ref: "):
+            break
+        ref = data[5:]
+
+    if cache is not None:
+        for ref in chain:
+            cache[ref] = data
+    return data
+
+def ref_list(repo, path=None, cache=None):
     if not path:
         path = repo_dir(repo, "refs")
+    if cache is None:
+        cache = dict()
     ret = collections.OrderedDict()
     # Git shows refs sorted.  To do the same, we use
-    # an OrderedDict and sort the output of listdir
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can)
-        else:
-            ret[f] = ref_resolve(repo, can)
+    # an OrderedDict and sort the directory entries.
+    # scandir tells us which entries are directories without
+    # another stat per entry.
+    # Directories are walked with an explicit stack of (directory,
+    # OrderedDict to fill) pairs rather than recursively, and the refs
+    # found are only resolved at the end, all in one go.
+    stack = [ (path, ret) ]
+    refs = list()
+    while stack:
+        path, out = stack.pop()
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for e in entries:
+            if e.is_dir():
+                out[e.name] = collections.OrderedDict()
+                stack.append((e.path, out[e.name]))
+            else:
+                out[e.name] = None # keeps the entry in its place until resolved
+                refs.append((out, e.name, e.path))
+
+    for out, name, path in refs:
+        out[name] = ref_resolve(repo, path, cache)
 
     return ret
 
@@ -707,6 +1391,8 @@ def cmd_show_ref(args):
     refs = ref_list(repo)
     show_ref(repo, refs, prefix="refs")
 
+argsp.set_defaults(func=cmd_show_ref)
+
 def show_ref(repo, refs, with_hash=True, prefix=""):
     for k, v in refs.items():
         if type(v) == str:
@@ -721,6 +1407,14 @@ def show_ref(repo, refs, with_hash=True, prefix=""):
 class GitTag(GitCommit):
     fmt = b'tag'
 
+# object constructors by type, now that all four object classes are defined
+object_constructors = {
+    b'commit': GitCommit,
+    b'tree': GitTree,
+    b'tag': GitTag,
+    b'blob': GitBlob,
+}
+
 argsp = argsubparsers.add_parser(
     "tag",
     help="List and create tags")
@@ -751,6 +1445,8 @@ def cmd_tag(args):
         refs = ref_list(repo)
         show_ref(repo, refs["tags"], with_hash=False)
 
+argsp.set_defaults(func=cmd_tag)
+
 def tag_create(repo, name, ref, create_tag_object=False):
     # get the GitObject from the object reference
     sha = object_find(repo, ref)
@@ -781,6 +1477,11 @@ def ref_create(repo, ref_name, sha):
 # referring to objects
 # the "object_find" function
 
+# a full or short (4 digits or more) object hash
+hash_re = re.compile(r"^[0-9A-Fa-f]{4,40}$")
+# the name of a loose object file, in objects/XX/
+loose_object_name_re = re.compile(r"[0-9a-f]{38}")
+
 def object_resolve(repo, name):
     """Resolve name to an object hash in repo.
 
@@ -792,7 +1493,6 @@ This function is aware of:
     - branches
     - remote branches"""
     candidates = list()
-    hashRE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
 
     # Empty string?  Abort.
     if not name.strip():
@@ -803,7 +1503,7 @@ This function is aware of:
         return [ ref_resolve(repo, "HEAD") ]
 
     # If it's a hex string, try for a hash.
-    if hashRE.match(name):
+    if hash_re.match(name):
         # This may be a hash, either small or full.  4 seems to be the
         # minimal length for git to consider something a short hash.
         # This limit is documented in man git-rev-parse
@@ -812,11 +1512,18 @@ This function is aware of:
         path = repo_dir(repo, "objects", prefix, mkdir=False)
         if path:
             rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    # Notice a string startswith() itself, so this
-                    # works for full hashes.
-                    candidates.append(prefix + f)
+            # scandir yields the entries as it reads them, so we can stop
+            # at the second match: two candidates is already ambiguous.
+            with os.scandir(path) as it:
+                for f in it:
+                    # (anything else in there, like a leftover temporary
+                    # file, isn't an object)
+                    if f.name.startswith(rem) and loose_object_name_re.fullmatch(f.name):
+                        # Notice a string startswith() itself, so this
+                        # works for full hashes.
+                        candidates.append(prefix + f.name)
+                        if len(candidates) > 1:
+                            break
 
     # Try for references.
     as_tag = ref_resolve(repo, "refs/tags/" + name)
@@ -845,23 +1552,23 @@ def object_find(repo, name, fmt=None, follow=True):
           return sha
 
       while True:
-          obj = object_read(repo, sha)
-          #     ^^^^^^^^^^^ < this is a bit agressive: we're reading
-          # the full object just to get its type.  And we're doing
-          # that in a loop, albeit normally short.  Don't expect
-          # high performance here.
+          # Only decompress the header to get the type: the full
+          # object is read only when we have to follow it.
+          obj_fmt = object_peek_fmt(repo, sha)
+          if obj_fmt is None:
+              raise Exception("No such object {0}.".format(sha))
 
-          if obj.fmt == fmt:
+          if obj_fmt == fmt:
               return sha
 
           if not follow:
               return None
 
           # Follow tags
-          if obj.fmt == b'tag':
-                sha = obj.kvlm[b'object'].decode("ascii")
-          elif obj.fmt == b'commit' and fmt == b'tree':
-                sha = obj.kvlm[b'tree'].decode("ascii")
+          if obj_fmt == b'tag':
+                sha = object_read(repo, sha).kvlm[b'object'].decode("ascii")
+          elif obj_fmt == b'commit' and fmt == b'tree':
+                sha = object_read(repo, sha).kvlm[b'tree'].decode("ascii")
           else:
               return None
 
@@ -890,6 +1597,8 @@ def cmd_rev_parse(args):
 
     print (object_find(repo, args.name, fmt, follow=True))
 
+argsp.set_defaults(func=cmd_rev_parse)
+
 ############################################################################################
 #---------------------------------- STAGING AREA & INDEX ----------------------------------#
 ############################################################################################
@@ -908,6 +1617,12 @@ Again, this is because git/wyag status will need to determine which files in the
 timestamp and comparing it with a known values, before comparing actual files.
 """
 class GitIndexEntry (object):
+    # An index holds one entry per tracked file, so entries are kept
+    # small: with __slots__, an instance has no __dict__ of its own.
+    __slots__ = ("ctime", "mtime", "dev", "ino", "mode_type", "mode_perms",
+                 "uid", "gid", "fsize", "sha", "flag_assume_valid",
+                 "flag_stage", "name")
+
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
                  fsize=None, sha=None, flag_assume_valid=None,
@@ -943,7 +1658,7 @@ class GitIndexEntry (object):
 # index file is a binary file
 class GitIndex (object):
     version = None
-    entries = []
+    entries = None # a list, but not one shared by every instance
     # ext = None
     # sha = None
 
@@ -954,13 +1669,42 @@ class GitIndex (object):
         self.version = version
         self.entries = entries
 
+# The fixed-size part of an index entry, 62 bytes: ctime (seconds,
+# nanoseconds), mtime (seconds, nanoseconds), dev, ino, 16 unused bits,
+# mode, uid, gid, size, SHA and flags, all big-endian.  One precompiled
+# Struct decodes it in a single call, instead of a from_bytes per field.
+index_entry_struct = struct.Struct(">6I2H3I20sH")
+
+# parsed index files, keyed by path: {path: (file_stamp, version, entries)}
+# The entries are kept as a tuple, and every caller gets a GitIndex with
+# a list of its own: changing it (and not writing it back, say because
+# add failed halfway) doesn't change what the next index_read returns.
+index_cache = dict()
+
+def index_read_long_name(raw, content, idx):
+    """Read a name of 0xFFF bytes or more, starting at idx in content
+    (the entries of raw).  Return the name and the index right after it.
+    This is rare enough to be kept out of index_read's loop."""
+    print("Notice: Name is 0x{:X} bytes long.".format(0xFFF))
+    # This probably wasn't tested enough.  It works with a
+    # path of exactly 0xFFF bytes.  Any extra bytes broke
+    # something between git, my shell and my filesystem.
+    null_idx = raw.find(b'\x00', 12 + idx + 0xFFF) - 12 # (memoryviews have no find)
+    return content[idx: null_idx], null_idx + 1
+
 def index_read(repo):
     index_file = repo_file(repo, "index")
 
     # New repositories have no index!
-    if not os.path.exists(index_file):
+    stamp = file_stamp(index_file)
+    if stamp is None:
         return GitIndex()
 
+    # Reuse the last parse if the file hasn't changed since
+    cached = index_cache.get(index_file)
+    if cached and cached[0] == stamp:
+        return GitIndex(version=cached[1], entries=list(cached[2]))
+
     with open(index_file, 'rb') as f:
         raw = f.read()
 
@@ -971,43 +1715,31 @@ def index_read(repo):
     assert version == 2, "wyag only supports index file version 2"
     count = int.from_bytes(header[8:12], "big")
 
-    entries = list()
+    # We know how many entries there are: allocate the list once
+    entries = [ None ] * count
 
-    content = raw[12:]
+    # A view on the entries, not a copy: slicing it doesn't copy either
+    content = memoryview(raw)[12:]
     idx = 0
+    unpack_entry = index_entry_struct.unpack_from
     for i in range(0, count):
-        # Read creation time, as a unix timestamp (seconds since
-        # 1970-01-01 00:00:00, the "epoch")
-        ctime_s =  int.from_bytes(content[idx: idx+4], "big")
-        # Read creation time, as nanoseconds after that timestamps,
-        # for extra precision.
-        ctime_ns = int.from_bytes(content[idx+4: idx+8], "big")
-        # Same for modification time: first seconds from epoch.
-        mtime_s = int.from_bytes(content[idx+8: idx+12], "big")
-        # Then extra nanoseconds
-        mtime_ns = int.from_bytes(content[idx+12: idx+16], "big")
-        # Device ID
-        dev = int.from_bytes(content[idx+16: idx+20], "big")
-        # Inode
-        ino = int.from_bytes(content[idx+20: idx+24], "big")
-        # Ignored.
-        unused = int.from_bytes(content[idx+24: idx+26], "big")
+        # Read the fixed-size fields, straight from the buffer:
+        #  - creation time, as a unix timestamp (seconds since
+        #    1970-01-01 00:00:00, the "epoch"), then as nanoseconds after
+        #    that timestamp, for extra precision
+        #  - same for modification time
+        #  - device ID, inode, 16 ignored bits, mode
+        #  - user ID, group ID, size
+        #  - SHA (object ID), and flags
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, unused, mode,
+         uid, gid, fsize, sha, flags) = unpack_entry(content, idx)
         assert 0 == unused
-        mode = int.from_bytes(content[idx+26: idx+28], "big")
         mode_type = mode >> 12
         assert mode_type in [0b1000, 0b1010, 0b1110]
         mode_perms = mode & 0b0000000111111111
-        # User ID
-        uid = int.from_bytes(content[idx+28: idx+32], "big")
-        # Group ID
-        gid = int.from_bytes(content[idx+32: idx+36], "big")
-        # Size
-        fsize = int.from_bytes(content[idx+36: idx+40], "big")
-        # SHA (object ID).  We'll store it as a lowercase hex string
-        # for consistency.
-        sha = format(int.from_bytes(content[idx+40: idx+60], "big"), "040x")
-        # Flags we're going to ignore
-        flags = int.from_bytes(content[idx+60: idx+62], "big")
+        # We'll store the SHA as a lowercase hex string for consistency.
+        # (bytes.hex always gives two digits per byte, so it's zero-padded)
+        sha = sha.hex()
         # Parse flags
         flag_assume_valid = (flags & 0b1000000000000000) != 0
         flag_extended = (flags & 0b0100000000000000) != 0
@@ -1029,38 +1761,33 @@ def index_read(repo):
             raw_name = content[idx:idx+name_length]
             idx += name_length + 1
         else:
-            print("Notice: Name is 0x{:X} bytes long.".format(name_length))
-            # This probably wasn't tested enough.  It works with a
-            # path of exactly 0xFFF bytes.  Any extra bytes broke
-            # something between git, my shell and my filesystem.
-            null_idx = content.find(b'\x00', idx + 0xFFF)
-            raw_name = content[idx: null_idx]
-            idx = null_idx + 1
+            raw_name, idx = index_read_long_name(raw, content, idx)
 
-        # Just parse the name as utf8.
-        name = raw_name.decode("utf8")
+        # Just parse the name as utf8 (straight from the view).
+        name = str(raw_name, "utf8")
 
         # Data is padded on multiples of eight bytes for pointer
         # alignment, so we skip as many bytes as we need for the next
         # read to start at the right position.
 
-        idx = 8 * ceil(idx / 8)
+        idx = (idx + 7) & ~7 # round up to a multiple of 8, in integers
 
         # And we add this entry to our list.
-        entries.append(GitIndexEntry(ctime=(ctime_s, ctime_ns),
-                                     mtime=(mtime_s,  mtime_ns),
-                                     dev=dev,
-                                     ino=ino,
-                                     mode_type=mode_type,
-                                     mode_perms=mode_perms,
-                                     uid=uid,
-                                     gid=gid,
-                                     fsize=fsize,
-                                     sha=sha,
-                                     flag_assume_valid=flag_assume_valid,
-                                     flag_stage=flag_stage,
-                                     name=name))
-
+        entries[i] = GitIndexEntry(ctime=(ctime_s, ctime_ns),
+                                   mtime=(mtime_s,  mtime_ns),
+                                   dev=dev,
+                                   ino=ino,
+                                   mode_type=mode_type,
+                                   mode_perms=mode_perms,
+                                   uid=uid,
+                                   gid=gid,
+                                   fsize=fsize,
+                                   sha=sha,
+                                   flag_assume_valid=flag_assume_valid,
+                                   flag_stage=flag_stage,
+                                   name=name)
+
+    index_cache[index_file] = (stamp, version, tuple(entries))
     return GitIndex(version=version, entries=entries)
 
 # ls-files command
@@ -1089,13 +1816,36 @@ def cmd_ls_files(args):
         , e.mtime[1]))
       print("  device: {}, inode: {}".format(e.dev, e.ino))
       print("  user: {} ({})  group: {} ({})".format(
-        pwd.getpwuid(e.uid).pw_name,
+        user_name(e.uid),
         e.uid,
-        grp.getgrgid(e.gid).gr_name,
+        group_name(e.gid),
         e.gid))
       print("  flags: stage={} assume_valid={}".format(
         e.flag_stage,
         e.flag_assume_valid))
+
+argsp.set_defaults(func=cmd_ls_files)
+
+# Looking up a user or a group may go through NSS (and LDAP, ...), and
+# an index holds files from only one or two owners: remember the names.
+# IDs with no name (or no user database at all) are shown as numbers.
+@functools.lru_cache(maxsize=256)
+def user_name(uid):
+    if pwd is None:
+        return str(uid)
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+@functools.lru_cache(maxsize=256)
+def group_name(gid):
+    if grp is None:
+        return str(gid)
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return str(gid)
       
  # check-ignore command
 argsp = argsubparsers.add_parser("check-ignore", help = "Check path(s) against ignore rules.")
@@ -1108,6 +1858,8 @@ def cmd_check_ignore(args):
       if check_ignore(rules, path):
         print(path)
 
+argsp.set_defaults(func=cmd_check_ignore)
+
 def gitignore_parse1(raw):
     raw = raw.strip() # Remove leading/trailing spaces
 
@@ -1120,15 +1872,35 @@ def gitignore_parse1(raw):
     else:
         return (raw, True)
 
-def gitignore_parse(lines):
-    ret = list()
-
-    for line in lines:
-        parsed = gitignore_parse1(line)
-        if parsed:
-            ret.append(parsed)
+# A set of rules, from an ignore file (or several, read as one)
+# Matching a path against each pattern in turn with fnmatch costs a
+# Python call (and a regex match) per pattern.  Instead, all the patterns
+# are translated to regular expressions and joined into one alternation,
+# so a path is checked against the whole file with a single match.
+class GitIgnoreRules(object):
+    rules = None # the (pattern, value) pairs, in file order
+    regex = None # all the patterns, as a single regex (None if there are no rules)
+
+    def __init__(self, rules):
+        self.rules = rules
+        # In an ignore file, the last matching pattern wins.  Alternatives
+        # are tried in order, so we list the patterns backwards: the first
+        # one that matches is then the last one in the file.  Each is a
+        # named group, to tell which one it was.
+        if rules:
+            self.regex = re.compile("|".join(
+                "(?P<r{0}>{1})".format(i, translate(pattern))
+                for i, (pattern, value) in reversed(list(enumerate(rules)))))
+
+# blank lines and comments, which gitignore_parse1 would only discard
+gitignore_skip_re = re.compile(r"^\s*(#|$)")
 
-    return ret
+def gitignore_parse(lines):
+    # Ignore files are often mostly comments and blank lines: drop
+    # those with a single regex match, then parse what's left (which
+    # gitignore_parse1 always turns into a rule).
+    skip = gitignore_skip_re.match
+    return GitIgnoreRules([ gitignore_parse1(line) for line in lines if not skip(line) ])
 
 class GitIgnore(object):
     absolute = None
@@ -1138,62 +1910,97 @@ class GitIgnore(object):
         self.absolute = absolute
         self.scoped = scoped
 
-def gitignore_read(repo):
-    ret = GitIgnore(absolute=list(), scoped=dict())
+# the last rules read for each repository: {gitdir: (stamps, GitIgnore)}
+gitignore_cache = dict()
 
-    # Read local configuration in .git/info/exclude
+def gitignore_read(repo, index=None):
+    """Read the ignore rules of repo.  Callers that already hold the
+    repository's index can pass it, so it isn't read again."""
     repo_file = os.path.join(repo.gitdir, "info/exclude")
-    if os.path.exists(repo_file):
-        with open(repo_file, "r") as f:
-            ret.absolute.append(gitignore_parse(f.readlines()))
-
-    # Global configuration
     if "XDG_CONFIG_HOME" in os.environ:
         config_home = os.environ["XDG_CONFIG_HOME"]
     else:
         config_home = os.path.expanduser("~/.config")
     global_file = os.path.join(config_home, "git/ignore")
 
-    if os.path.exists(global_file):
+    # .gitignore files in the index
+    if index is None:
+        index = index_read(repo)
+
+    # Find them in a single pass over the entries.
+    entries = [ e for e in index.entries
+                if e.name == ".gitignore" or e.name.endswith("/.gitignore") ]
+
+    # The rules come from these .gitignore blobs and from the two files:
+    # as long as none of them changed, the rules we read last time are
+    # still good.  (The blobs are keyed by name and sha, not by the index
+    # file's stamp: the caller's index needn't be the one on disk.)
+    stamps = (tuple((e.name, e.sha) for e in entries), file_stamp(repo_file), file_stamp(global_file))
+    cached = gitignore_cache.get(repo.gitdir)
+    if cached and cached[0] == stamps:
+        return cached[1]
+
+    # The local configuration (.git/info/exclude) takes precedence over
+    # the global one.  Since the last matching rule wins, putting the
+    # global rules first and the local ones after lets us match both
+    # files as a single ruleset.
+    lines = list()
+
+    # Global configuration
+    if stamps[2] is not None:
         with open(global_file, "r") as f:
-            ret.absolute.append(gitignore_parse(f.readlines()))
+            lines.extend(f.readlines())
 
-    # .gitignore files in the index
-    index = index_read(repo)
+    # Read local configuration in .git/info/exclude
+    if stamps[1] is not None:
+        with open(repo_file, "r") as f:
+            lines.extend(f.readlines())
 
-    for entry in index.entries:
-        if entry.name == ".gitignore" or entry.name.endswith("/.gitignore"):
-            dir_name = os.path.dirname(entry.name)
-            contents = object_read(repo, entry.sha)
-            lines = contents.blobdata.decode("utf8").splitlines()
-            ret.scoped[dir_name] = gitignore_parse(lines)
+    ret = GitIgnore(absolute=gitignore_parse(lines), scoped=dict())
+
+    # There are only a few .gitignore files, and they're small: they're
+    # read one after the other, there's nothing to gain from the thread pool.
+    for entry in entries:
+        dir_name = os.path.dirname(entry.name)
+        contents = object_read(repo, entry.sha)
+        lines = str(contents.blobdata, "utf8").splitlines()
+        ret.scoped[dir_name] = gitignore_parse(lines)
+
+    gitignore_cache[repo.gitdir] = (stamps, ret)
     return ret
 
 def check_ignore1(rules, path):
-    result = None
-    for (pattern, value) in rules:
-        if fnmatch(path, pattern):
-            result = value
-    return result
+    if not rules.regex:
+        return None
+    m = rules.regex.match(path)
+    if not m:
+        return None
+    return rules.rules[int(m.lastgroup[1:])][1] # the value of the rule that matched
+
+# Paths are checked against the rules of each directory above them,
+# nearest first.  Many paths share the same directory, so the chains
+# are computed once (a split, rather than a dirname call per level) and
+# cached.
+@functools.lru_cache(maxsize=4096)
+def dir_parents(path):
+    """path, then each directory above it, down to "" (the root)."""
+    if not path:
+        return ("",)
+    parts = path.split("/")
+    return tuple("/".join(parts[:i]) for i in range(len(parts), -1, -1))
 
 def check_ignore_scoped(rules, path):
-    parent = os.path.dirname(path)
-    while True:
+    for parent in dir_parents(path.rpartition("/")[0]):
         if parent in rules:
             result = check_ignore1(rules[parent], path)
             if result != None:
                 return result
-        if parent == "":
-            break
-        parent = os.path.dirname(parent)
     return None
 
 def check_ignore_absolute(rules, path):
-    parent = os.path.dirname(path)
-    for ruleset in rules:
-        result = check_ignore1(ruleset, path)
-        if result != None:
-            return result
+    result = check_ignore1(rules, path)
+    if result != None:
+        return result
     return False # This is a reasonable default at this point.
 
 def check_ignore(rules, path):
@@ -1218,6 +2025,8 @@ def cmd_status(_):
     print()
     cmd_status_index_worktree(repo, index)
 
+argsp.set_defaults(func=cmd_status)
+
 def branch_get_active(repo):
     with open(repo_file(repo, "HEAD"), "r") as f:
         head = f.read()
@@ -1277,7 +2086,7 @@ def cmd_status_head_index(repo, index):
 def cmd_status_index_worktree(repo, index):
     print("Changes not staged for commit:")
 
-    ignore = gitignore_read(repo)
+    ignore = gitignore_read(repo, index)
 
     gitdir_prefix = repo.gitdir + os.path.sep
 
@@ -1295,6 +2104,10 @@ def cmd_status_index_worktree(repo, index):
     # We now traverse the index, and compare real files with the cached
     # versions.
 
+    # Files that differ from the index by metadata only are rehashed on
+    # every status; the hash cache saves reading them again next time.
+    cache = hashcache_read(repo)
+
     for entry in index.entries:
         full_path = os.path.join(repo.worktree, entry.name)
 
@@ -1312,7 +2125,7 @@ def cmd_status_index_worktree(repo, index):
                 # If different, deep compare.
                 # @FIXME This *will* crash on symlinks to dir.
                 with open(full_path, "rb") as fd:
-                    new_sha = object_hash(fd, b"blob", None)
+                    new_sha = object_hash(fd, b"blob", None, cache)
                     # If the hashes are the same, the files are actually the same.
                     same = entry.sha == new_sha
 
@@ -1322,6 +2135,8 @@ def cmd_status_index_worktree(repo, index):
         if entry.name in all_files:
             all_files.remove(entry.name)
 
+    hashcache_write(cache)
+
     print()
     print("Untracked files:")
 
@@ -1332,6 +2147,7 @@ def cmd_status_index_worktree(repo, index):
             print(" ", f)
 
 def index_write(repo, index):
+    index_cache.pop(repo_file(repo, "index"), None) # whatever we parsed before is stale now
     with open(repo_file(repo, "index"), "wb") as f:
 
         # HEADER
@@ -1397,6 +2213,8 @@ def cmd_rm(args):
   repo = repo_find()
   rm(repo, args.path)
 
+argsp.set_defaults(func=cmd_rm)
+
 def rm(repo, paths, delete=True, skip_missing=False):
   # Find and read the index
   index = index_read(repo)
@@ -1441,6 +2259,8 @@ def cmd_add(args):
   repo = repo_find()
   add(repo, args.path)
 
+argsp.set_defaults(func=cmd_add)
+
 def add(repo, paths, delete=True, skip_missing=False):
 
   # First remove all paths from the index, if they exist.
@@ -1500,14 +2320,20 @@ def gitconfig_read():
         os.path.expanduser("~/.gitconfig")
     ]
 
-    config = configparser.ConfigParser()
-    config.read(configfiles)
-    return config
+    # Parse the files as one: a section repeated in a later file is
+    # merged into the first one, and its keys win.
+    text = ""
+    for path in configfiles:
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                text += f.read() + "\n"
+    return GitConfig(text)
 
 def gitconfig_user_get(config):
-    if "user" in config:
-        if "name" in config["user"] and "email" in config["user"]:
-            return "{} <{}>".format(config["user"]["name"], config["user"]["email"])
+    name = config.get("user", "name", None)
+    email = config.get("user", "email", None)
+    if name is not None and email is not None:
+        return "{} <{}>".format(name, email)
     return None
 
 def tree_from_index(repo, index):
@@ -1613,4 +2439,6 @@ def cmd_commit(args):
             fd.write(commit + "\n")
     else: # Otherwise, we update HEAD itself.
         with open(repo_file(repo, "HEAD"), "w") as fd:
-            fd.write("\n")
\ No newline at end of file
+            fd.write("\n")
+
+argsp.set_defaults(func=cmd_commit)